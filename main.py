@@ -1,15 +1,19 @@
-from datetime import date, datetime
-from flask import Flask, abort, render_template, redirect, url_for, flash, jsonify
+import datetime
+from flask import Flask, abort, render_template, redirect, url_for, flash, jsonify, request
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
-from flask_gravatar import Gravatar
+from flask_caching import Cache
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user, login_required
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String, Text
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, selectinload, undefer
+from sqlalchemy import Integer, String, Text, Date
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 import os
+import hashlib
 import jinja2
 # Import your forms from the forms.py
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
@@ -20,13 +24,35 @@ ckeditor = CKEditor(app)
 Bootstrap5(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
+# Home page cache. gunicorn runs several workers (see Procfile), so production uses Redis
+# to make cache.clear() reach all of them. Without REDIS_URL (local app.run) an
+# in-process cache is enough. The key prefix keeps clear() from flushing the whole Redis db
+if os.environ.get('REDIS_URL'):
+    cache = Cache(app, config={
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': os.environ.get('REDIS_URL'),
+        'CACHE_KEY_PREFIX': 'myblog_',
+    })
+else:
+    cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
+POSTS_PER_PAGE = 20
+# Upper bound for ?page= so the offset stays a sane integer
+MAX_PAGES = 1000
 
 
 # CREATE DATABASE
 class Base(DeclarativeBase):
     pass
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('POSTGRESQL_DB', 'SQLALCHEMY_DB')
-db = SQLAlchemy(model_class=Base)
+# Explicit connection pool; POSTGRESQL_DB can point at PgBouncer (pool_mode=transaction)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
+# Keep loaded objects (and their eager-loaded relationships) usable after commit
+db = SQLAlchemy(model_class=Base, session_options={'expire_on_commit': False})
 db.init_app(app)
 
 
@@ -35,12 +61,12 @@ class BlogPost(db.Model):
     __tablename__ = "blog_posts"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     # Create Foreign Key, "users.id" the users refers to the tablename of User.
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"), index=True)
     # Create reference to the User object. The "posts" refers to the posts property in the User class.
     author = relationship("User", back_populates="posts")
     title: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     subtitle: Mapped[str] = mapped_column(String(250), nullable=False)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False, index=True)
     body: Mapped[str] = mapped_column(Text, nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
     # Parent relationship to the comments
@@ -52,8 +78,11 @@ class User(UserMixin, db.Model):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     email: Mapped[str] = mapped_column(String(100), unique=True)
-    password: Mapped[str] = mapped_column(String(100))
+    # Only loaded when needed (login), keeps the hash out of every other user query
+    password: Mapped[str] = mapped_column(String(200), deferred=True)
     name: Mapped[str] = mapped_column(String(100))
+    # MD5 of the normalized email, precomputed for the gravatar URL
+    email_md5: Mapped[str] = mapped_column(String(32), nullable=False)
     # This will act like a list of BlogPost objects attached to each User.
     # The "author" refers to the author property in the BlogPost class.
     posts = relationship("BlogPost", back_populates="author")
@@ -68,10 +97,10 @@ class Comment(db.Model):
     text: Mapped[str] = mapped_column(Text, nullable=False)
     # Child relationship:"users.id" The users refers to the tablename of the User class.
     # "comments" refers to the comments property in the User class.
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"), index=True)
     comment_author = relationship("User", back_populates="comments")
     # Child Relationship to the BlogPosts
-    post_id: Mapped[str] = mapped_column(Integer, db.ForeignKey("blog_posts.id"))
+    post_id: Mapped[str] = mapped_column(Integer, db.ForeignKey("blog_posts.id"), index=True)
     parent_post = relationship("BlogPost", back_populates="comments")
 
 
@@ -79,56 +108,69 @@ with app.app_context():
     db.create_all()
 
 
-gravatar = Gravatar(
-            app,
-            size=100,
-            rating='g',
-            default='retro',
-            force_default=False,
-            force_lower=False,
-            use_ssl=False,
-            base_url=None
-        )
+def gravatar_hash(email):
+    return hashlib.md5(email.strip().lower().encode()).hexdigest()
+
+
+# argon2id with OWASP's 19 MiB / 2 iterations profile. Every gunicorn thread can hash
+# at once, so keep memory_cost * threads * workers (see Procfile) well inside the dyno
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19 * 1024, parallelism=1)
+
+
+def verify_password(user, password):
+    # Accounts created before the switch to argon2 still have Werkzeug PBKDF2 hashes,
+    # upgrade them to argon2 the first time they log in successfully
+    if not user.password.startswith('$argon2'):
+        if not check_password_hash(user.password, password):
+            return False
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+        return True
+
+    try:
+        password_hasher.verify(user.password, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+    if password_hasher.check_needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+    return True
 
 
 # TODO: Configure Flask-Login
 # This function does not need to be called anywhere!
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    # session.get checks the identity map first and returns None for unknown ids
+    return db.session.get(User, int(user_id))
 
 
-# Helper function(decorator)
-def get_current_user(func):
-    def wrapper(*args, **kwargs):
-        if current_user and hasattr(current_user, 'name') and hasattr(current_user, 'is_authenticated'):
-            the_current_user = current_user.name
-            if the_current_user:
-                print(f"\nUser: {the_current_user} is authenticated: {current_user.is_authenticated}\n")
-            else:
-                print(f"\nUser not authenticated!")
-        else:
-            print(f"\nUser NOT logged in!\n")
-
-        return func(*args, **kwargs)
-
-    wrapper.__name__ = func.__name__
-    return wrapper
+# Log who is making each request, only when debugging
+@app.before_request
+def log_current_user():
+    if not app.debug:
+        return
+    if current_user.is_authenticated:
+        app.logger.debug("User: %s is authenticated", current_user.name)
+    else:
+        app.logger.debug("User NOT logged in!")
 
 
 # Get all users
 @app.route("/all-users")
 def get_all_users():
-    result = db.session.execute(db.select(User))
-    all_users = result.scalars().all()
-
-    user_dict = {'users': {}}
-    for user in all_users:
-        user_dict['users'][user.name] = {
-                    'id': user.id,
-                    'name': user.name,
-                    'email': user.email
+    # Only select the columns we return, no ORM objects and no password hashes
+    result = db.session.execute(db.select(User.id, User.name, User.email))
+
+    user_dict = {'users': {
+                name: {
+                    'id': user_id,
+                    'name': name,
+                    'email': email
                 }
+                for user_id, name, email in result
+            }}
 
     return jsonify(user_dict)
 
@@ -138,7 +180,7 @@ def admin_only(f):
     @wraps(f)
     @login_required
     def wrapper(*args, **kwargs):
-        if not current_user.is_authenticated and current_user.id != 1:
+        if not current_user.is_authenticated or current_user.id != 1:
             return abort(403)
         return f(*args, **kwargs)
     return wrapper
@@ -147,7 +189,6 @@ def admin_only(f):
 
 # TODO: Use Werkzeug to hash the user's password when creating a new user.
 @app.route('/register', methods=['GET', 'POST'])
-@get_current_user
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
@@ -155,35 +196,32 @@ def register():
         user_password = form.password.data
         user_name = form.name.data
 
-        duplicate_email = db.session.execute(db.select(User).where(User.email == user_email))
-        user = duplicate_email.scalar()
-    
-        if user:
-            flash("You already have an account with this email, please login.")
-            return redirect(url_for('login'))
-        else:
-            print(f"\nAdding user: '{user_name}' to database\n")
+        hashed_and_salted_pwd = password_hasher.hash(user_password)
 
-            hashed_and_salted_pwd = generate_password_hash(
-                    user_password,
-                    method='pbkdf2:sha256',
-                    salt_length=8
-                )
-        
-            new_user = User(
+        # Insert and detect a duplicate email in one atomic statement
+        new_user = db.session.scalar(
+                pg_insert(User)
+                .values(
                     email=user_email,
                     password=hashed_and_salted_pwd,
-                    name=user_name
+                    name=user_name,
+                    email_md5=gravatar_hash(user_email)
                 )
+                .on_conflict_do_nothing(index_elements=['email'])
+                .returning(User)
+            )
+        db.session.commit()
+
+        if not new_user:
+            flash("You already have an account with this email, please login.")
+            return redirect(url_for('login'))
+        else:
+            print(f"\nAdded user: '{user_name}' to database\n")
 
-            db.session.add(new_user)
-            db.session.commit()
-            
             login_user(new_user)
         
             print(f"Name: {new_user.name}")
-            print(f"Email: {new_user.email}")
-            print(f"Password: {new_user.password}\n")
+            print(f"Email: {new_user.email}\n")
             return redirect(url_for('get_all_posts'))
 
     return render_template("register.html", form=form, logged_in=current_user.is_authenticated)
@@ -191,7 +229,6 @@ def register():
 
 # TODO: Retrieve a user from the database based on their email. 
 @app.route('/login', methods=['GET', 'POST'])
-@get_current_user
 def login():
     form = LoginForm()
 
@@ -199,20 +236,14 @@ def login():
         user_email = form.email.data
         user_password = form.password.data
     
-        existing_user = db.session.execute(db.select(User).where(User.email == user_email))
-        user = existing_user.scalar()
+        user = db.session.scalar(
+                db.select(User).where(User.email == user_email).options(undefer(User.password))
+            )
 
-        # For debugging purposes
-        result = db.session.execute(db.select(User))
-        all_users = result.scalars().all()
-        
-        print(f"\nall existing user emails: {[user.email for user in all_users]}")
-        print(f"all existing usernames: {[user.name for user in all_users]}\n")
-    
         if not user:
             flash("That email does not exist, please try again.")
             return redirect(url_for('login'))
-        elif not check_password_hash(user.password, user_password):
+        elif not verify_password(user, user_password):
             flash("Password incorrect, please try again.")
             return redirect(url_for('login'))
         elif current_user.is_authenticated:
@@ -220,33 +251,58 @@ def login():
             return redirect(url_for('login'))
         else:
             login_user(user)
-            print(f"\nUser: '{user.name}' successfully logged in")
-            print(f"'load_user(user.id).id': {load_user(user.id).id}\n")
+            print(f"\nUser: '{user.name}' successfully logged in\n")
             return redirect(url_for('get_all_posts'))
 
     return render_template("login.html", form=form, logged_in=current_user.is_authenticated)
 
 
 @app.route('/logout')
-@get_current_user
 def logout():
     if current_user.is_authenticated:
         logout_user()
         return redirect(url_for('get_all_posts'))
 
 @app.route('/')
-@get_current_user
+# Only anonymous visitors get the cached page, logged-in users see their own header.
+# The cache key includes the query string so every ?page= is cached separately
+@cache.cached(timeout=60, query_string=True, unless=lambda: current_user.is_authenticated)
 def get_all_posts():
-    result = db.session.execute(db.select(BlogPost))
-    posts = result.scalars().all()
-    return render_template("index.html", all_posts=posts, logged_in=current_user.is_authenticated)
+    page = request.args.get('page', 1, type=int)
+    if page < 1 or page > MAX_PAGES:
+        abort(404)
+    # Newest posts first (id breaks ties within a day), load every post's author in one
+    # extra query instead of one per post. One extra row tells us if there is an older page
+    posts = db.session.scalars(
+            db.select(BlogPost)
+            .order_by(BlogPost.date.desc(), BlogPost.id.desc())
+            .offset((page - 1) * POSTS_PER_PAGE)
+            .limit(POSTS_PER_PAGE + 1)
+            .options(selectinload(BlogPost.author))
+        ).all()
+    if not posts and page > 1:
+        abort(404)
+    has_older = len(posts) > POSTS_PER_PAGE
+    return render_template(
+            "index.html",
+            all_posts=posts[:POSTS_PER_PAGE],
+            page=page,
+            has_older=has_older,
+            logged_in=current_user.is_authenticated
+        )
 
 
 # TODO: Allow logged-in users to comment on posts
 @app.route("/post/<int:post_id>", methods=['GET', 'POST'])
-@get_current_user
 def show_post(post_id):
-    requested_post = db.get_or_404(BlogPost, post_id)
+    # Load the comments and their authors up front to avoid a query per comment
+    requested_post = db.session.get(
+            BlogPost,
+            post_id,
+            options=[selectinload(BlogPost.comments).selectinload(Comment.comment_author)]
+        )
+    if requested_post is None:
+        abort(404)
 
     # Add CommentForm
     comment_form = CommentForm()
@@ -266,7 +322,6 @@ def show_post(post_id):
 # TODO: Use a decorator so only an admin user can create a new post
 @app.route("/new-post", methods=["GET", "POST"])
 @admin_only
-@get_current_user
 def add_new_post():
     form = CreatePostForm()
     if form.validate_on_submit():
@@ -276,10 +331,13 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=datetime.date.today()
         )
         db.session.add(new_post)
         db.session.commit()
+        # Home page keys depend on ?page=, only those pages are cached so clear them all.
+        # The cache is shared through Redis, so this reaches every gunicorn worker
+        cache.clear()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form, logged_in=current_user.is_authenticated)
 
@@ -287,9 +345,10 @@ def add_new_post():
 # TODO: Use a decorator so only an admin user can edit a post
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
-@get_current_user
 def edit_post(post_id):
-    post = db.get_or_404(BlogPost, post_id)
+    post = db.session.get(BlogPost, post_id)
+    if post is None:
+        abort(404)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -304,6 +363,7 @@ def edit_post(post_id):
         post.author = current_user
         post.body = edit_form.body.data
         db.session.commit()
+        cache.clear()
         return redirect(url_for("show_post", post_id=post.id))
     return render_template("make-post.html", form=edit_form, is_edit=True, logged_in=current_user.is_authenticated)
 
@@ -311,22 +371,42 @@ def edit_post(post_id):
 # TODO: Use a decorator so only an admin user can delete a post
 @app.route("/delete/<int:post_id>")
 @admin_only
-@get_current_user
 def delete_post(post_id):
-    post_to_delete = db.get_or_404(BlogPost, post_id)
+    post_to_delete = db.session.get(BlogPost, post_id)
+    if post_to_delete is None:
+        abort(404)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.clear()
     return redirect(url_for('get_all_posts'))
 
 
+# Pages with no database content that browsers may cache
+STATIC_PAGES = {'about', 'contact'}
+
+
+@app.after_request
+def add_cache_headers(response):
+    if request.method != 'GET' or request.endpoint not in STATIC_PAGES or response.status_code != 200:
+        return response
+    # The header shows the logged-in user's name, so only anonymous pages are public
+    # and the cached copy is keyed on the session cookie
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    response.vary.add('Cookie')
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 @app.route("/about")
-@get_current_user
 def about():
     return render_template("about.html", logged_in=current_user.is_authenticated)
 
 
 @app.route("/contact")
-@get_current_user
 def contact():
     return render_template("contact.html", logged_in=current_user.is_authenticated)
 
@@ -0,0 +1,55 @@
+from sqlalchemy import text
+# Importing main runs db.create_all(), so on a fresh database every table already exists
+from main import app, db
+
+
+# Schema changes that db.create_all() can't apply to existing tables.
+# Every statement is safe to run again, the script runs on each deploy (see Procfile).
+MIGRATIONS = [
+    # argon2 hashes need more room than the old 100 character column. Guarded so
+    # later deploys don't take a lock on users for a no-op type change
+    """
+    DO $$
+    BEGIN
+        IF (SELECT character_maximum_length FROM information_schema.columns
+            WHERE table_name = 'users' AND column_name = 'password') < 200 THEN
+            ALTER TABLE users ALTER COLUMN password TYPE varchar(200);
+        END IF;
+    END $$
+    """,
+    # Foreign key indexes, named the way SQLAlchemy names index=True columns
+    "CREATE INDEX IF NOT EXISTS ix_blog_posts_author_id ON blog_posts (author_id)",
+    "CREATE INDEX IF NOT EXISTS ix_comments_author_id ON comments (author_id)",
+    "CREATE INDEX IF NOT EXISTS ix_comments_post_id ON comments (post_id)",
+    # Gravatar hash, backfilled with the same normalization as gravatar_hash() in main.py
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS email_md5 varchar(32)",
+    "UPDATE users SET email_md5 = md5(lower(trim(email))) WHERE email_md5 IS NULL",
+    """
+    DO $$
+    BEGIN
+        IF (SELECT is_nullable FROM information_schema.columns
+            WHERE table_name = 'users' AND column_name = 'email_md5') = 'YES' THEN
+            ALTER TABLE users ALTER COLUMN email_md5 SET NOT NULL;
+        END IF;
+    END $$
+    """,
+    # Post dates used to be strings like 'October 29, 2025', convert them to a real DATE
+    """
+    DO $$
+    BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_name = 'blog_posts' AND column_name = 'date') <> 'date' THEN
+            ALTER TABLE blog_posts
+                ALTER COLUMN "date" TYPE date USING to_date("date", 'FMMonth DD, YYYY');
+        END IF;
+    END $$
+    """,
+    'CREATE INDEX IF NOT EXISTS ix_blog_posts_date ON blog_posts ("date")',
+]
+
+
+with app.app_context():
+    with db.engine.begin() as connection:
+        for statement in MIGRATIONS:
+            print(f"Running: {statement.strip()}")
+            connection.execute(text(statement))